@@ -1,19 +1,33 @@
 import os
+import sys
 import logging
-from typing import Optional
-from datetime import datetime
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
 import asyncio
+import random
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
+from telegram.error import RetryAfter
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
 import aiohttp
+import orjson
 from pydantic import BaseModel
 import time
-import re
 from colorama import init, Fore, Style
 
-# Initialize colorama
-init()
+# Цвета в логах используем только при выводе в терминал
+USE_COLORS = sys.stderr.isatty()
+if USE_COLORS:
+    init()
+
+COLOR_CYAN = Fore.CYAN if USE_COLORS else ""
+COLOR_GREEN = Fore.GREEN if USE_COLORS else ""
+COLOR_YELLOW = Fore.YELLOW if USE_COLORS else ""
+COLOR_RED = Fore.RED if USE_COLORS else ""
+COLOR_RESET = Style.RESET_ALL if USE_COLORS else ""
 
 # Load environment variables
 load_dotenv()
@@ -31,8 +45,13 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 VIDEO_API_KEY = os.getenv("VIDEO_API_KEY")
 
 PROGRESS_EMOJIS = ["⏳", "⌛️"]  # Чередовать при обновлении
+MAX_STORED_MESSAGES = 16  # Сколько последних сообщений бота удалять при очистке
+PROGRESS_EDIT_INTERVAL = 3.0  # Минимальный интервал между обновлениями сообщения (сек)
+POLL_MIN_DELAY = 1.0  # Начальный интервал опроса статуса задачи (сек)
+POLL_MAX_DELAY = 10.0  # Максимальный интервал опроса статуса задачи (сек)
+LONG_POLL_WAIT = 30  # Сколько сервер может держать запрос статуса задачи (сек)
 
-SUPPORTED_DOMAINS = [
+SUPPORTED_DOMAINS = frozenset({
     "youtube.com",
     "youtu.be",
     "vimeo.com",
@@ -43,25 +62,88 @@ SUPPORTED_DOMAINS = [
     "twitter.com",
     "x.com",
     "tiktok.com",
-    "vm.tiktok.com"
-]
+    "vm.tiktok.com",
+})
+
+# Параметры ссылок, которые не влияют на видео
+TRACKING_PARAMS = frozenset({"si", "feature", "fbclid", "gclid", "igshid"})
+
+# Кэш информации о видео: каноническая ссылка -> ответ /combined-info
+_video_info_cache: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_video_info_pending: Dict[str, asyncio.Task] = {}
+
+# Общая HTTP-сессия для всех запросов к API
+_session: Optional[aiohttp.ClientSession] = None
+
+def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию, создавая её при первом обращении."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=10, enable_cleanup_closed=True)
+        timeout = aiohttp.ClientTimeout(total=60, connect=10)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+async def close_session(application: Optional[Application] = None) -> None:
+    """Закрывает общую HTTP-сессию при остановке бота."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
 
 def is_valid_url(url: str) -> bool:
     """Проверяет, является ли строка корректной ссылкой на поддерживаемый сайт."""
-    # Базовая проверка на URL
-    url_pattern = re.compile(
-        r'^https?://'  # http:// или https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # домен
-        r'localhost|'  # localhost
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # IP
-        r'(?::\d+)?'  # порт
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    
-    if not url_pattern.match(url):
+    # Ссылка должна быть одним словом без пробелов
+    if len(url.split()) != 1:
         return False
     
-    # Проверка на поддерживаемые домены
-    return any(domain in url.lower() for domain in SUPPORTED_DOMAINS)
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return False
+    
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return False
+    
+    # Проверяем сам домен и все его родительские домены (m.youtube.com -> youtube.com)
+    host = parts.hostname.rstrip(".")
+    labels = host.split(".")
+    return any(".".join(labels[i:]) in SUPPORTED_DOMAINS for i in range(len(labels) - 1))
+
+# Качество по высоте кадра: (минимальная высота, текст кнопки, псевдоним формата для API)
+# Для 2K/4K псевдонима нет - используется format_id самого формата
+QUALITY_LEVELS = (
+    (2160, "📱 4K", None),
+    (1440, "🎮 2K", None),
+    (1080, "🖥 FullHD", "FullHD"),
+    (720, "📺 HD", "HD"),
+    (360, "📼 SD", "SD"),
+)
+
+_LEADING_DIGITS_RE = re.compile(r"\d+")
+
+def get_quality(resolution: str) -> Tuple[str, Optional[str]]:
+    """Возвращает текст кнопки и псевдоним формата по разрешению ("1280x720", "720p" или "1080p60")."""
+    sides = [_LEADING_DIGITS_RE.match(side.strip()) for side in resolution.lower().split("x")]
+    if not all(sides):
+        return "🎥", None
+    # Для вертикального видео качество определяет меньшая сторона кадра
+    height = min(int(side.group()) for side in sides)
+    
+    for min_height, quality_text, alias in QUALITY_LEVELS:
+        if height >= min_height:
+            return quality_text, alias
+    return "🎥", None
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+def format_size(size_bytes: float) -> str:
+    """Форматирует размер файла в человекочитаемый вид."""
+    for unit in SIZE_UNITS[:-1]:
+        if size_bytes < 1024:
+            return f"~{size_bytes:.1f} {unit}"
+        size_bytes /= 1024
+    return f"~{size_bytes:.1f} {SIZE_UNITS[-1]}"
 
 class VideoFormat(BaseModel):
     format_id: str
@@ -71,32 +153,33 @@ class VideoFormat(BaseModel):
     filesize: Optional[int]
     filesize_approx: Optional[int]
 
+def get_message_ids(context: ContextTypes.DEFAULT_TYPE) -> Deque[int]:
+    """Возвращает ограниченную очередь ID сообщений бота в чате."""
+    return context.chat_data.setdefault("message_ids", deque(maxlen=MAX_STORED_MESSAGES))
+
 async def cleanup_messages(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_message_id: Optional[int] = None):
     """Удаляет предыдущие сообщения бота и сообщение пользователя."""
-    if "message_ids" not in context.chat_data:
-        context.chat_data["message_ids"] = []
-    
-    # Удаляем сообщения бота
-    for message_id in context.chat_data["message_ids"]:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception as e:
-            logger.error(f"Error deleting message {message_id}: {e}")
+    stored_ids = get_message_ids(context)
+    message_ids = list(stored_ids)
     
     # Удаляем сообщение пользователя, если оно есть
     if user_message_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=user_message_id)
-        except Exception as e:
-            logger.error(f"Error deleting user message {user_message_id}: {e}")
+        message_ids.append(user_message_id)
+    
+    # Удаляем все сообщения параллельно
+    results = await asyncio.gather(
+        *(context.bot.delete_message(chat_id=chat_id, message_id=message_id) for message_id in message_ids),
+        return_exceptions=True
+    )
+    for message_id, result in zip(message_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error deleting message {message_id}: {result}")
     
-    context.chat_data["message_ids"] = []
+    stored_ids.clear()
 
 async def store_message(context: ContextTypes.DEFAULT_TYPE, message):
     """Сохраняет ID сообщения для последующей очистки."""
-    if "message_ids" not in context.chat_data:
-        context.chat_data["message_ids"] = []
-    context.chat_data["message_ids"].append(message.message_id)
+    get_message_ids(context).append(message.message_id)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
@@ -110,245 +193,341 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
     await store_message(context, message)
 
-async def log_api_request(method: str, url: str, params: dict = None, headers: dict = None):
+def log_api_request(method: str, url: str, params: dict = None, headers: dict = None):
     """Логирование API запросов с цветом."""
-    log_message = f"\n{Fore.CYAN}API Request:{Style.RESET_ALL}\n"
-    log_message += f"{Fore.GREEN}Method:{Style.RESET_ALL} {method}\n"
-    log_message += f"{Fore.GREEN}URL:{Style.RESET_ALL} {url}\n"
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    
+    log_message = f"\n{COLOR_CYAN}API Request:{COLOR_RESET}\n"
+    log_message += f"{COLOR_GREEN}Method:{COLOR_RESET} {method}\n"
+    log_message += f"{COLOR_GREEN}URL:{COLOR_RESET} {url}\n"
     
     if params:
-        log_message += f"{Fore.GREEN}Params:{Style.RESET_ALL}\n"
+        log_message += f"{COLOR_GREEN}Params:{COLOR_RESET}\n"
         for key, value in params.items():
-            log_message += f"  {Fore.YELLOW}{key}:{Style.RESET_ALL} {value}\n"
+            log_message += f"  {COLOR_YELLOW}{key}:{COLOR_RESET} {value}\n"
     
     if headers:
-        log_message += f"{Fore.GREEN}Headers:{Style.RESET_ALL}\n"
+        log_message += f"{COLOR_GREEN}Headers:{COLOR_RESET}\n"
         # Скрываем API ключ в логах
-        safe_headers = headers.copy()
-        if 'X-API-Key' in safe_headers:
-            safe_headers['X-API-Key'] = '***'
+        safe_headers = {**headers, 'X-API-Key': '***'} if 'X-API-Key' in headers else headers
         for key, value in safe_headers.items():
-            log_message += f"  {Fore.YELLOW}{key}:{Style.RESET_ALL} {value}\n"
+            log_message += f"  {COLOR_YELLOW}{key}:{COLOR_RESET} {value}\n"
     
     logger.info(log_message)
 
-async def log_api_response(status: int, data: str):
+def log_api_response(status: int, data: bytes):
     """Логирование ответов API с цветом."""
-    color = Fore.GREEN if 200 <= status < 300 else Fore.RED
-    log_message = f"\n{Fore.CYAN}API Response:{Style.RESET_ALL}\n"
-    log_message += f"{Fore.GREEN}Status:{Style.RESET_ALL} {color}{status}{Style.RESET_ALL}\n"
-    log_message += f"{Fore.GREEN}Data:{Style.RESET_ALL}\n{data}\n"
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    
+    data = data.decode(errors="replace")
+    color = COLOR_GREEN if 200 <= status < 300 else COLOR_RED
+    log_message = f"\n{COLOR_CYAN}API Response:{COLOR_RESET}\n"
+    log_message += f"{COLOR_GREEN}Status:{COLOR_RESET} {color}{status}{COLOR_RESET}\n"
+    log_message += f"{COLOR_GREEN}Data:{COLOR_RESET}\n{data}\n"
     logger.info(log_message)
 
-async def get_video_info(url: str) -> dict:
+async def _fetch_video_info(url: str) -> dict:
     """Get video information from API."""
-    async with aiohttp.ClientSession() as session:
-        headers = {"X-API-Key": VIDEO_API_KEY}
-        params = {"url": url}
-        full_url = f"{API_BASE_URL}/combined-info"
-        
-        await log_api_request("GET", full_url, params, headers)
-        
-        try:
-            async with session.get(full_url, params=params, headers=headers) as response:
-                response_text = await response.text()
-                await log_api_response(response.status, response_text)
-                
-                if response.status != 200:
-                    raise Exception(f"API error: {response_text}")
-                return await response.json()
-        except Exception as e:
-            logger.error(f"{Fore.RED}Error in get_video_info: {str(e)}{Style.RESET_ALL}")
-            raise
+    session = get_session()
+    headers = {"X-API-Key": VIDEO_API_KEY}
+    params = {"url": url}
+    full_url = f"{API_BASE_URL}/combined-info"
+    
+    log_api_request("GET", full_url, params, headers)
+    
+    try:
+        async with session.get(full_url, params=params, headers=headers) as response:
+            raw = await response.read()
+            log_api_response(response.status, raw)
+            
+            if response.status != 200:
+                raise Exception(f"API error: {raw.decode(errors='replace')}")
+            return orjson.loads(raw)
+    except Exception as e:
+        logger.error(f"{COLOR_RED}Error in get_video_info: {str(e)}{COLOR_RESET}")
+        raise
+
+def canonicalize_url(url: str) -> str:
+    """Приводит ссылку к каноническому виду для ключа кэша."""
+    parts = urlsplit(url.strip())
+    host = parts.hostname or ""
+    if host.startswith("www.") or host.startswith("m."):
+        host = host.split(".", 1)[1]
+    path = parts.path.rstrip("/")
+    
+    # Убираем трекинговые параметры
+    query = [
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key not in TRACKING_PARAMS
+    ]
+    
+    # youtu.be/<id> -> youtube.com/watch?v=<id>
+    if host == "youtu.be" and path:
+        host = "youtube.com"
+        query.insert(0, ("v", path.lstrip("/")))
+        path = "/watch"
+    
+    return urlunsplit(("https", host, path, urlencode(query), ""))
+
+async def _load_video_info(key: str, url: str) -> dict:
+    """Загружает информацию о видео и сохраняет её в кэш."""
+    try:
+        video_info = await _fetch_video_info(url)
+        _video_info_cache[key] = video_info
+        return video_info
+    finally:
+        _video_info_pending.pop(key, None)
+
+async def get_video_info(url: str) -> dict:
+    """Get video information, using the cache and sharing in-flight requests."""
+    key = canonicalize_url(url)
+    video_info = _video_info_cache.get(key)
+    if video_info is not None:
+        logger.info(f"Video info cache hit: {key}")
+        return video_info
+    
+    # Одновременные запросы одной и той же ссылки ждут один вызов API
+    task = _video_info_pending.get(key)
+    if task is None:
+        task = asyncio.create_task(_load_video_info(key, url))
+        _video_info_pending[key] = task
+    return await asyncio.shield(task)
 
 async def create_download_task(url: str, format_id: str, is_audio: bool = False) -> dict:
     """Create a download task."""
-    async with aiohttp.ClientSession() as session:
-        headers = {
-            "X-API-Key": VIDEO_API_KEY,
-            "accept": "application/json"
+    session = get_session()
+    headers = {
+        "X-API-Key": VIDEO_API_KEY,
+        "accept": "application/json"
+    }
+    
+    if is_audio:
+        endpoint = f"{API_BASE_URL}/audio/download"
+        params = {
+            "url": url,
+            "format": "high",  # Используем высокое качество для аудио
+            "convert_to_mp3": "true"
         }
-        
-        if is_audio:
-            endpoint = f"{API_BASE_URL}/audio/download"
-            params = {
-                "url": url,
-                "format": "high",  # Используем высокое качество для аудио
-                "convert_to_mp3": "true"
-            }
+    else:
+        endpoint = f"{API_BASE_URL}/download"
+        # Определяем качество видео на основе format_id
+        if format_id in ["SD", "HD", "FullHD"]:
+            format_param = format_id
         else:
-            endpoint = f"{API_BASE_URL}/download"
-            # Определяем качество видео на основе format_id
-            if format_id in ["SD", "HD", "FullHD"]:
-                format_param = format_id
-            else:
-                format_param = format_id
-                
-            params = {
-                "url": url,
-                "format": format_param
-            }
-        
-        await log_api_request("GET", endpoint, params, headers)
-        
-        async with session.get(endpoint, params=params, headers=headers) as response:
-            response_text = await response.text()
-            await log_api_response(response.status, response_text)
+            format_param = format_id
             
-            if response.status == 202:  # API возвращает 202 при успешном создании задачи
-                return await response.json()
-            else:
-                raise Exception(f"API error: {response_text}")
+        params = {
+            "url": url,
+            "format": format_param
+        }
+    
+    log_api_request("GET", endpoint, params, headers)
+    
+    async with session.get(endpoint, params=params, headers=headers) as response:
+        raw = await response.read()
+        log_api_response(response.status, raw)
+        
+        if response.status == 202:  # API возвращает 202 при успешном создании задачи
+            return orjson.loads(raw)
+        else:
+            raise Exception(f"API error: {raw.decode(errors='replace')}")
+
+class ApiRateLimitError(Exception):
+    """API вернул 429 Too Many Requests."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"API rate limit exceeded, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+def _parse_retry_after(value: Optional[str]) -> float:
+    """Разбирает заголовок Retry-After (в секундах), по умолчанию ждем POLL_MAX_DELAY."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return POLL_MAX_DELAY
 
-async def check_download_progress(task_id: str, session: aiohttp.ClientSession, headers: dict) -> dict:
+async def check_download_progress(task_id: str, headers: dict) -> dict:
     """Check download task progress."""
+    session = get_session()
     url = f"{API_BASE_URL}/download/{task_id}"
-    await log_api_request("GET", url, headers=headers)
+    # Long-poll: сервер может держать запрос до LONG_POLL_WAIT секунд, пока статус не изменится
+    params = {"wait": str(LONG_POLL_WAIT)}
+    timeout = aiohttp.ClientTimeout(total=LONG_POLL_WAIT + 5)
+    log_api_request("GET", url, params, headers)
     
     try:
-        async with session.get(url, headers=headers) as response:
-            response_text = await response.text()
-            await log_api_response(response.status, response_text)
+        async with session.get(url, params=params, headers=headers, timeout=timeout) as response:
+            raw = await response.read()
+            log_api_response(response.status, raw)
             
+            if response.status == 429:
+                raise ApiRateLimitError(_parse_retry_after(response.headers.get("Retry-After")))
             if response.status != 200:
-                raise Exception(f"API returned status {response.status}: {response_text}")
-            return await response.json()
+                raise Exception(f"API returned status {response.status}: {raw.decode(errors='replace')}")
+            return orjson.loads(raw)
     except Exception as e:
-        logger.error(f"{Fore.RED}Error in check_download_progress: {str(e)}{Style.RESET_ALL}")
+        logger.error(f"{COLOR_RED}Error in check_download_progress: {str(e)}{COLOR_RESET}")
         raise
 
-def create_progress_bar(progress: int) -> str:
+# Все возможные состояния индикатора прогресса (12 блоков)
+PROGRESS_BAR_LENGTH = 12
+PROGRESS_BARS = tuple(
+    "▓" * filled + "░" * (PROGRESS_BAR_LENGTH - filled)
+    for filled in range(PROGRESS_BAR_LENGTH + 1)
+)
+EMPTY_PROGRESS_BAR = PROGRESS_BARS[0]
+
+# Статусы задачи на русском
+STATUS_TEXTS = {
+    "pending": "Ожидание...",
+    "processing": "Обработка...",
+    "downloading": "Скачивание...",
+    "completed": "Завершено",
+    "error": "Ошибка"
+}
+
+def create_progress_bar(progress: float) -> str:
     """Создает индикатор прогресса."""
-    filled = "▓" * int(progress / 8.33)  # 12 блоков всего
-    empty = "░" * (12 - int(progress / 8.33))
-    return f"{filled}{empty}"
+    if progress <= 0:
+        return EMPTY_PROGRESS_BAR
+    filled = min(PROGRESS_BAR_LENGTH, int(progress * PROGRESS_BAR_LENGTH / 100))
+    return PROGRESS_BARS[filled]
+
+async def edit_message(message, text: str, **kwargs):
+    """Редактирует подпись сообщения с обложкой или текст обычного сообщения."""
+    if message.photo:
+        return await message.edit_caption(caption=text, **kwargs)
+    return await message.edit_text(text, **kwargs)
 
 async def update_progress_message(message, task_id: str, video_title: str):
     """Update progress message periodically."""
     headers = {"X-API-Key": VIDEO_API_KEY}
     
+    # Неизменяемые части сообщения о прогрессе
+    header = f"*🟩 Загрузка видео...*\n\n🎬 Название: {video_title}\n"
+    footer = "\n💡 Пожалуйста, подождите."
+    
     # Используем существующее сообщение с обложкой
-    progress_text = (
-        "*🟩 Загрузка видео...*\n\n"
-        f"🎬 Название: {video_title}\n"
-        "⏳ Прогресс: ░░░░░░░░░░░░ 0%\n"
-        "📂 Статус: Инициализация...\n"
-        "💡 Пожалуйста, подождите."
-    )
+    progress_text = f"{header}⏳ Прогресс: {EMPTY_PROGRESS_BAR} 0%\n📂 Статус: Инициализация...{footer}"
     
-    try:
-        await message.edit_caption(caption=progress_text, parse_mode='Markdown')
-    except Exception:
-        await message.edit_text(progress_text, parse_mode='Markdown')
+    await edit_message(message, progress_text, parse_mode='Markdown')
     
-    async with aiohttp.ClientSession() as session:
-        retry_count = 0
-        max_retries = 3
-        
-        while True:
-            try:
-                logger.info(f"Checking progress for task {task_id}")
-                task_info = await check_download_progress(task_id, session, headers)
-                logger.info(f"Task info received: {task_info}")
-                
-                status = task_info.get("status", "pending")
-                progress = task_info.get("progress", 0)
-                
+    retry_count = 0
+    max_retries = 3
+    last_key = (None, None)
+    last_edit_ts = time.monotonic()
+    last_status = None
+    delay = POLL_MIN_DELAY
+    
+    while True:
+        try:
+            logger.info(f"Checking progress for task {task_id}")
+            request_started = time.monotonic()
+            task_info = await check_download_progress(task_id, headers)
+            # Считаем ответ long-poll, только если сервер держал запрос почти всё время wait;
+            # медленный ответ сервера без поддержки wait так не засчитывается
+            long_polled = time.monotonic() - request_started >= LONG_POLL_WAIT * 0.9
+            logger.info(f"Task info received: {task_info}")
+            
+            status = task_info.get("status", "pending")
+            progress = task_info.get("progress", 0)
+            
+            # Обновляем сообщение только если прогресс изменился и прошло достаточно времени.
+            # Завершение без ссылки показываем сразу; при наличии ссылки ниже
+            # будет отправлено финальное сообщение, поэтому прогресс не обновляем
+            key = (status, int(progress))
+            throttled = time.monotonic() - last_edit_ts < PROGRESS_EDIT_INTERVAL
+            if status == "completed":
+                show_progress = not task_info.get("download_url") and key != last_key
+            else:
+                show_progress = key != last_key and not throttled
+            if show_progress:
                 # Создаем индикатор прогресса
                 progress_bar = create_progress_bar(progress)
                 
                 # Определяем статус на русском
-                status_text = {
-                    "pending": "Ожидание...",
-                    "processing": "Обработка...",
-                    "downloading": "Скачивание...",
-                    "completed": "Завершено",
-                    "error": "Ошибка"
-                }.get(status, status)
+                status_text = STATUS_TEXTS.get(status, status)
                 
-                message_text = (
-                    "*🟩 Загрузка видео...*\n\n"
-                    f"🎬 Название: {video_title}\n"
-                    f"⏳ Прогресс: {progress_bar} {progress:.1f}%\n"
-                    f"📂 Статус: {status_text}\n"
-                    "💡 Пожалуйста, подождите."
-                )
+                message_text = f"{header}⏳ Прогресс: {progress_bar} {progress:.1f}%\n📂 Статус: {status_text}{footer}"
                 
-                try:
-                    await message.edit_caption(caption=message_text, parse_mode='Markdown')
-                except Exception:
-                    await message.edit_text(message_text, parse_mode='Markdown')
-                
-                if status == "completed":
-                    if task_info.get("download_url"):
-                        # Создаем кнопку для скачивания
-                        keyboard = [[InlineKeyboardButton("⬇️ Скачать", url=task_info['download_url'])]]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-                        
-                        completed_text = (
-                            "*✅ Загрузка завершена!*\n\n"
-                            f"🎬 Название: {video_title}\n\n"
-                            "🔗 Ссылка для скачивания:\n\n"
-                            "⚠️ Ссылка действительна в течение ограниченного времени."
-                        )
-                        try:
-                            await message.edit_caption(
-                                caption=completed_text,
-                                parse_mode='Markdown',
-                                reply_markup=reply_markup
-                            )
-                        except Exception:
-                            await message.edit_text(
-                                completed_text,
-                                parse_mode='Markdown',
-                                reply_markup=reply_markup
-                            )
-                    break
-                elif status == "error":
-                    error_message = task_info.get("error", "Неизвестная ошибка")
-                    error_text = (
-                        "*❌ Ошибка при скачивании!*\n\n"
-                        f"🎬 Название: {video_title}\n"
-                        f"❗️ Детали: {error_message}"
-                    )
-                    try:
-                        await message.edit_caption(caption=error_text, parse_mode='Markdown')
-                    except Exception:
-                        await message.edit_text(error_text, parse_mode='Markdown')
-                    break
-                elif status == "pending" and retry_count >= max_retries:
-                    timeout_text = (
-                        "*⚠️ Превышено время ожидания!*\n\n"
-                        f"🎬 Название: {video_title}\n"
-                        "❗️ Пожалуйста, попробуйте позже."
+                await edit_message(message, message_text, parse_mode='Markdown')
+                last_key = key
+                last_edit_ts = time.monotonic()
+            
+            if status == "completed":
+                if task_info.get("download_url"):
+                    # Создаем кнопку для скачивания
+                    keyboard = [[InlineKeyboardButton("⬇️ Скачать", url=task_info['download_url'])]]
+                    reply_markup = InlineKeyboardMarkup(keyboard)
+                    
+                    completed_text = (
+                        "*✅ Загрузка завершена!*\n\n"
+                        f"🎬 Название: {video_title}\n\n"
+                        "🔗 Ссылка для скачивания:\n\n"
+                        "⚠️ Ссылка действительна в течение ограниченного времени."
                     )
-                    try:
-                        await message.edit_caption(caption=timeout_text, parse_mode='Markdown')
-                    except Exception:
-                        await message.edit_text(timeout_text, parse_mode='Markdown')
-                    break
-                
-                retry_count = 0  # Сбрасываем счетчик при успешном запросе
-                await asyncio.sleep(2)  # Проверяем каждые 2 секунды
-                
-            except Exception as e:
-                logger.error(f"Error checking progress: {str(e)}")
-                retry_count += 1
-                
-                if retry_count >= max_retries:
-                    error_text = (
-                        "*❌ Ошибка при отслеживании прогресса!*\n\n"
-                        f"🎬 Название: {video_title}\n"
-                        f"❗️ Детали: {str(e)}\n"
-                        "💡 Попробуйте повторить запрос позже."
+                    await edit_message(
+                        message,
+                        completed_text,
+                        parse_mode='Markdown',
+                        reply_markup=reply_markup
                     )
-                    try:
-                        await message.edit_caption(caption=error_text, parse_mode='Markdown')
-                    except Exception:
-                        await message.edit_text(error_text, parse_mode='Markdown')
-                    break
-                
-                await asyncio.sleep(2 * retry_count)
+                break
+            elif status == "error":
+                error_message = task_info.get("error", "Неизвестная ошибка")
+                error_text = (
+                    "*❌ Ошибка при скачивании!*\n\n"
+                    f"🎬 Название: {video_title}\n"
+                    f"❗️ Детали: {error_message}"
+                )
+                await edit_message(message, error_text, parse_mode='Markdown')
+                break
+            elif status == "pending" and retry_count >= max_retries:
+                timeout_text = (
+                    "*⚠️ Превышено время ожидания!*\n\n"
+                    f"🎬 Название: {video_title}\n"
+                    "❗️ Пожалуйста, попробуйте позже."
+                )
+                await edit_message(message, timeout_text, parse_mode='Markdown')
+                break
+            
+            retry_count = 0  # Сбрасываем счетчик при успешном запросе
+            
+            # Экспоненциально увеличиваем интервал опроса, пока статус не меняется
+            if status != last_status:
+                delay = POLL_MIN_DELAY
+                last_status = status
+            elif not long_polled:
+                delay = min(delay * 1.5, POLL_MAX_DELAY)
+            
+            # После long-poll ответа (сервер уже ждал за нас) сразу отправляем следующий запрос,
+            # иначе опрашиваем с задержкой
+            if not long_polled:
+                await asyncio.sleep(delay + random.uniform(0, 0.5))
+            
+        except ApiRateLimitError as e:
+            logger.warning(str(e))
+            await asyncio.sleep(e.retry_after)
+        except RetryAfter as e:
+            # Telegram просит подождать: ждем и не считаем это ошибкой
+            logger.warning(f"Flood control exceeded, retrying in {e.retry_after} seconds")
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Error checking progress: {str(e)}")
+            retry_count += 1
+            
+            if retry_count >= max_retries:
+                error_text = (
+                    "*❌ Ошибка при отслеживании прогресса!*\n\n"
+                    f"🎬 Название: {video_title}\n"
+                    f"❗️ Детали: {str(e)}\n"
+                    "💡 Попробуйте повторить запрос позже."
+                )
+                await edit_message(message, error_text, parse_mode='Markdown')
+                break
+            
+            await asyncio.sleep(2 * retry_count)
 
 async def handle_video_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle video URL messages."""
@@ -393,42 +572,15 @@ async def handle_video_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         
         # Получаем все доступные форматы
         formats = video_info.get("video_formats", [])
-        
-        def format_size(size_bytes: int) -> str:
-            for unit in ['B', 'KB', 'MB', 'GB']:
-                if size_bytes < 1024:
-                    return f"~{size_bytes:.1f} {unit}"
-                size_bytes /= 1024
-            return f"~{size_bytes:.1f} TB"
+        context.user_data["format_by_id"] = {f.get("format_id"): f for f in formats}
         
         # Группируем форматы по качеству
         for format in formats:
             if format.get("resolution") and format.get("filesize_approx"):
                 resolution = format.get("resolution", "")
                 size = format_size(format.get("filesize_approx"))
-                quality_text = ""
-                format_id = ""
-                
-                if "480" in resolution or "360" in resolution:
-                    quality_text = "📼 SD"
-                    format_id = "SD"
-                elif "720" in resolution:
-                    quality_text = "📺 HD"
-                    format_id = "HD"
-                elif "1080" in resolution:
-                    quality_text = "🖥 FullHD"
-                    format_id = "FullHD"
-                elif "1440" in resolution:
-                    quality_text = "🎮 2K"
-                    format_id = format.get("format_id", "")
-                elif "2160" in resolution:
-                    quality_text = "📱 4K"
-                    format_id = format.get("format_id", "")
-                elif "3840" in resolution:
-                    quality_text = "🖥 4K UHD"
-                    format_id = format.get("format_id", "")
-                else:
-                    quality_text = "🎥"
+                quality_text, format_id = get_quality(resolution)
+                if not format_id:
                     format_id = format.get("format_id", "")
                 
                 button_text = f"{quality_text} ({size})"
@@ -542,96 +694,28 @@ async def handle_format_selection(update: Update, context: ContextTypes.DEFAULT_
         if format_type == "audio":
             # Создаем задачу на скачивание аудио
             download_task = await create_download_task(video_url, "", is_audio=True)
-            
-            if "task_id" in download_task:
-                await update_progress_message(
-                    query.message,
-                    download_task["task_id"],
-                    f"{video_info.get('title', 'Аудио')} (Аудио)"
-                )
-            elif "error" in download_task:
-                error_message = await query.message.reply_text(
-                    f"❌ Ошибка при создании задачи: {download_task['error']}"
-                )
-                await store_message(context, error_message)
-            else:
-                # Если получили информацию о формате без task_id, создаем новую задачу
-                format_id = download_task.get("format", "")
-                if format_id:
-                    format_task = await create_download_task(video_url, format_id, is_audio=True)
-                    if "task_id" in format_task:
-                        await update_progress_message(
-                            query.message,
-                            format_task["task_id"],
-                            f"{video_info.get('title', 'Аудио')} (Аудио)"
-                        )
-                    else:
-                        error_message = await query.message.reply_text(
-                            "❌ Не удалось создать задачу на скачивание аудио."
-                        )
-                        await store_message(context, error_message)
-                else:
-                    error_message = await query.message.reply_text(
-                        "❌ Не удалось получить информацию о формате аудио."
-                    )
-                    await store_message(context, error_message)
+            title = f"{video_info.get('title', 'Аудио')} (Аудио)"
         else:
             # Создаем задачу на скачивание видео
             download_task = await create_download_task(video_url, format_type)
             
-            if "task_id" in download_task:
-                # Находим информацию о выбранном формате
-                selected_format = next(
-                    (f for f in video_info.get("video_formats", [])
-                     if f["format_id"] == format_type),
-                    None
-                )
-                
-                quality_str = ""
-                if selected_format and selected_format.get("resolution"):
-                    quality_str = f" ({selected_format['resolution']})"
-                
-                await update_progress_message(
-                    query.message,
-                    download_task["task_id"],
-                    f"{video_info.get('title', 'Видео')}{quality_str}"
-                )
-            elif "error" in download_task:
-                error_message = await query.message.reply_text(
-                    f"❌ Ошибка при создании задачи: {download_task['error']}"
-                )
-                await store_message(context, error_message)
-            else:
-                # Если получили информацию о формате без task_id, создаем новую задачу
-                format_id = download_task.get("format", "")
-                if format_id:
-                    format_task = await create_download_task(video_url, format_id)
-                    if "task_id" in format_task:
-                        selected_format = next(
-                            (f for f in video_info.get("video_formats", [])
-                             if f["format_id"] == format_type),
-                            None
-                        )
-                        
-                        quality_str = ""
-                        if selected_format and selected_format.get("resolution"):
-                            quality_str = f" ({selected_format['resolution']})"
-                        
-                        await update_progress_message(
-                            query.message,
-                            format_task["task_id"],
-                            f"{video_info.get('title', 'Видео')}{quality_str}"
-                        )
-                    else:
-                        error_message = await query.message.reply_text(
-                            "❌ Не удалось создать задачу на скачивание видео."
-                        )
-                        await store_message(context, error_message)
-                else:
-                    error_message = await query.message.reply_text(
-                        "❌ Не удалось получить информацию о формате видео."
-                    )
-                    await store_message(context, error_message)
+            # Находим информацию о выбранном формате
+            selected_format = context.user_data.get("format_by_id", {}).get(format_type)
+            
+            quality_str = ""
+            if selected_format and selected_format.get("resolution"):
+                quality_str = f" ({selected_format['resolution']})"
+            title = f"{video_info.get('title', 'Видео')}{quality_str}"
+        
+        # API всегда возвращает task_id в ответе 202, повторный запрос не нужен
+        if "task_id" in download_task:
+            await update_progress_message(query.message, download_task["task_id"], title)
+        else:
+            error_details = download_task.get("error", "API не вернул идентификатор задачи")
+            error_message = await query.message.reply_text(
+                f"❌ Ошибка при создании задачи: {error_details}"
+            )
+            await store_message(context, error_message)
                     
     except Exception as e:
         logger.error(f"Error creating download task: {e}")
@@ -651,7 +735,15 @@ def main() -> None:
         logger.error("Video API key not found!")
         return
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Ограничиваем исходящие запросы к Telegram (30 сообщений/сек, 20 сообщений/мин в группу)
+        # и повторяем запрос после RetryAfter
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_shutdown(close_session)
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))